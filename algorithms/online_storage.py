@@ -39,10 +39,11 @@ class OnlineStorage(object):
         self.prev_state = torch.zeros(num_steps + 1, num_processes, state_dim)
         if self.args.pass_latent_to_policy:
             # latent variables (of VAE)
+            # (pre-allocated, like the other buffers; index 0 holds the latent we started the rollout with)
             self.latent_dim = latent_dim
-            self.latent_samples = []
-            self.latent_mean = []
-            self.latent_logvar = []
+            self.latent_samples = torch.zeros(num_steps + 1, num_processes, latent_dim)
+            self.latent_mean = torch.zeros(num_steps + 1, num_processes, latent_dim)
+            self.latent_logvar = torch.zeros(num_steps + 1, num_processes, latent_dim)
             # hidden states of RNN (necessary if we want to re-compute embeddings)
             self.hidden_size = hidden_size
             self.hidden_states = torch.zeros(num_steps + 1, num_processes, hidden_size)
@@ -90,9 +91,9 @@ class OnlineStorage(object):
         if self.args.pass_state_to_policy:
             self.prev_state = self.prev_state.to(device)
         if self.args.pass_latent_to_policy:
-            self.latent_samples = [t.to(device) for t in self.latent_samples]
-            self.latent_mean = [t.to(device) for t in self.latent_mean]
-            self.latent_logvar = [t.to(device) for t in self.latent_logvar]
+            self.latent_samples = self.latent_samples.to(device)
+            self.latent_mean = self.latent_mean.to(device)
+            self.latent_logvar = self.latent_logvar.to(device)
             self.hidden_states = self.hidden_states.to(device)
             self.next_state = self.next_state.to(device)
         if self.args.pass_belief_to_policy:
@@ -131,9 +132,9 @@ class OnlineStorage(object):
         if self.args.pass_task_to_policy:
             self.tasks[self.step + 1].copy_(task)
         if self.args.pass_latent_to_policy:
-            self.latent_samples.append(latent_sample.detach().clone())
-            self.latent_mean.append(latent_mean.detach().clone())
-            self.latent_logvar.append(latent_logvar.detach().clone())
+            self.latent_samples[self.step + 1].copy_(latent_sample.detach())
+            self.latent_mean[self.step + 1].copy_(latent_mean.detach())
+            self.latent_logvar[self.step + 1].copy_(latent_logvar.detach())
             self.hidden_states[self.step + 1].copy_(hidden_states.detach())
         self.actions[self.step] = actions.detach().clone()
         self.rewards_raw[self.step].copy_(rewards_raw)
@@ -154,9 +155,11 @@ class OnlineStorage(object):
         if self.args.pass_task_to_policy:
             self.tasks[0].copy_(self.tasks[-1])
         if self.args.pass_latent_to_policy:
-            self.latent_samples = []
-            self.latent_mean = []
-            self.latent_logvar = []
+            # (the first entry is overwritten at the start of the next rollout;
+            # we only have to cut the graph if the embeddings were re-computed with gradients)
+            self.latent_samples = self.latent_samples.detach()
+            self.latent_mean = self.latent_mean.detach()
+            self.latent_logvar = self.latent_logvar.detach()
             self.hidden_states[0].copy_(self.hidden_states[-1])
         self.done[0].copy_(self.done[-1])
         self.masks[0].copy_(self.masks[-1])
@@ -208,12 +211,9 @@ class OnlineStorage(object):
 
     def before_update(self, policy):
         latent = utl.get_latent_for_policy(self.args,
-                                           latent_sample=torch.stack(
-                                               self.latent_samples[:-1]) if self.latent_samples is not None else None,
-                                           latent_mean=torch.stack(
-                                               self.latent_mean[:-1]) if self.latent_mean is not None else None,
-                                           latent_logvar=torch.stack(
-                                               self.latent_logvar[:-1]) if self.latent_mean is not None else None)
+                                           latent_sample=self.latent_samples[:-1] if self.latent_samples is not None else None,
+                                           latent_mean=self.latent_mean[:-1] if self.latent_mean is not None else None,
+                                           latent_logvar=self.latent_logvar[:-1] if self.latent_mean is not None else None)
         _, action_log_probs, _ = policy.evaluate_actions(self.prev_state[:-1],
                                                          latent,
                                                          self.beliefs[:-1] if self.beliefs is not None else None,
@@ -240,37 +240,52 @@ class OnlineStorage(object):
             SubsetRandomSampler(range(batch_size)),
             mini_batch_size,
             drop_last=True)
+
+        # flatten the (num_steps, num_processes, ...) buffers once; the minibatches just index into these
+        # (the storage already lives on the GPU, so there's no host-side batch preparation to overlap)
+        # the latents are not flattened here: they get replaced between minibatches if the RL loss
+        # is backpropagated through the encoder (see utl.recompute_embeddings)
+        state = self.prev_state[:-1].reshape(-1, *self.prev_state.size()[2:]) if self.args.pass_state_to_policy else None
+        beliefs = self.beliefs[:-1].reshape(-1, *self.beliefs.size()[2:]) if self.args.pass_belief_to_policy else None
+        tasks = self.tasks[:-1].reshape(-1, *self.tasks.size()[2:]) if self.args.pass_task_to_policy else None
+        actions = self.actions.reshape(-1, self.actions.size(-1))
+        value_preds = self.value_preds[:-1].reshape(-1, 1)
+        returns = self.returns[:-1].reshape(-1, 1)
+        action_log_probs = self.action_log_probs.reshape(-1, 1)
+        if advantages is not None:
+            advantages = advantages.reshape(-1, 1)
+
         for indices in sampler:
 
             if self.args.pass_state_to_policy:
-                state_batch = self.prev_state[:-1].reshape(-1, *self.prev_state.size()[2:])[indices]
+                state_batch = state[indices]
             else:
                 state_batch = None
             if self.args.pass_latent_to_policy:
-                latent_sample_batch = torch.cat(self.latent_samples[:-1])[indices]
-                latent_mean_batch = torch.cat(self.latent_mean[:-1])[indices]
-                latent_logvar_batch = torch.cat(self.latent_logvar[:-1])[indices]
+                latent_sample_batch = self.latent_samples[:-1].reshape(-1, self.latent_dim)[indices]
+                latent_mean_batch = self.latent_mean[:-1].reshape(-1, self.latent_dim)[indices]
+                latent_logvar_batch = self.latent_logvar[:-1].reshape(-1, self.latent_dim)[indices]
             else:
                 latent_sample_batch = latent_mean_batch = latent_logvar_batch = None
             if self.args.pass_belief_to_policy:
-                belief_batch = self.beliefs[:-1].reshape(-1, *self.beliefs.size()[2:])[indices]
+                belief_batch = beliefs[indices]
             else:
                 belief_batch = None
             if self.args.pass_task_to_policy:
-                task_batch = self.tasks[:-1].reshape(-1, *self.tasks.size()[2:])[indices]
+                task_batch = tasks[indices]
             else:
                 task_batch = None
 
-            actions_batch = self.actions.reshape(-1, self.actions.size(-1))[indices]
+            actions_batch = actions[indices]
 
-            value_preds_batch = self.value_preds[:-1].reshape(-1, 1)[indices]
-            return_batch = self.returns[:-1].reshape(-1, 1)[indices]
+            value_preds_batch = value_preds[indices]
+            return_batch = returns[indices]
 
-            old_action_log_probs_batch = self.action_log_probs.reshape(-1, 1)[indices]
+            old_action_log_probs_batch = action_log_probs[indices]
             if advantages is None:
                 adv_targ = None
             else:
-                adv_targ = advantages.reshape(-1, 1)[indices]
+                adv_targ = advantages[indices]
 
             yield state_batch, belief_batch, task_batch, \
                   actions_batch, \
@@ -44,6 +44,16 @@ def get_args(rest_args):
     parser.add_argument('--policy_layers', nargs='+', default=[128, 128])
     parser.add_argument('--policy_activation_function', type=str, default='tanh', help='tanh/relu/leaky-relu')
     parser.add_argument('--policy_initialisation', type=str, default='normc', help='normc/orthogonal')
+    parser.add_argument('--policy_compile', type=boolean_argument, default=False,
+                        help='compile actor/critic with torch.compile (needs PyTorch 2.0+)')
+    parser.add_argument('--policy_compile_mode', type=str, default='max-autotune',
+                        help='torch.compile mode for the policy (default/reduce-overhead/max-autotune)')
+    parser.add_argument('--policy_shared_trunk', type=boolean_argument, default=False,
+                        help='actor and critic share the hidden layers (only the output heads are separate)')
+    parser.add_argument('--policy_cuda_graph', type=boolean_argument, default=False,
+                        help='capture action selection in a CUDA graph (needs PyTorch 1.10+ and a GPU)')
+    parser.add_argument('--policy_bf16_inference', type=boolean_argument, default=False,
+                        help='select actions in bfloat16 autocast (training stays in float32; needs a GPU)')
     parser.add_argument('--policy_anneal_lr', type=boolean_argument, default=True)
 
     # RL algorithm
@@ -39,6 +39,16 @@ def get_args(rest_args):
     parser.add_argument('--policy_layers', nargs='+', default=[128, 128])
     parser.add_argument('--policy_activation_function', type=str, default='tanh', help='tanh/relu/leaky-relu')
     parser.add_argument('--policy_initialisation', type=str, default='normc', help='normc/orthogonal')
+    parser.add_argument('--policy_compile', type=boolean_argument, default=False,
+                        help='compile actor/critic with torch.compile (needs PyTorch 2.0+)')
+    parser.add_argument('--policy_compile_mode', type=str, default='max-autotune',
+                        help='torch.compile mode for the policy (default/reduce-overhead/max-autotune)')
+    parser.add_argument('--policy_shared_trunk', type=boolean_argument, default=False,
+                        help='actor and critic share the hidden layers (only the output heads are separate)')
+    parser.add_argument('--policy_cuda_graph', type=boolean_argument, default=False,
+                        help='capture action selection in a CUDA graph (needs PyTorch 1.10+ and a GPU)')
+    parser.add_argument('--policy_bf16_inference', type=boolean_argument, default=False,
+                        help='select actions in bfloat16 autocast (training stays in float32; needs a GPU)')
     parser.add_argument('--policy_anneal_lr', type=boolean_argument, default=False, help='anneal LR over time')
 
     # RL algorithm
@@ -76,6 +86,8 @@ def get_args(rest_args):
 
     # general
     parser.add_argument('--lr_vae', type=float, default=0.001)
+    parser.add_argument('--lr_vae_enc', type=float, default=None, help='learning rate for the encoder; None uses lr_vae')
+    parser.add_argument('--lr_vae_dec', type=float, default=None, help='learning rate for the decoders; None uses lr_vae')
     parser.add_argument('--size_vae_buffer', type=int, default=10000,
                         help='how many trajectories (!) to keep in VAE buffer')
     parser.add_argument('--precollect_len', type=int, default=5000,
@@ -103,6 +115,12 @@ def get_args(rest_args):
                         help='split batches up by task (to save memory or if tasks are of different length)')
     parser.add_argument('--split_batches_by_elbo', type=boolean_argument, default=False,
                         help='split batches up by elbo term (to save memory of if ELBOs are of different length)')
+    parser.add_argument('--vae_bf16_autocast', type=boolean_argument, default=False,
+                        help='run the encoder and decoders in bfloat16 autocast (KL and optimiser stay in float32; needs a GPU)')
+    parser.add_argument('--vae_compile', type=boolean_argument, default=False,
+                        help='compile the encoder and decoders with torch.compile (needs PyTorch 2.0+)')
+    parser.add_argument('--vae_overlap_decoders', type=boolean_argument, default=False,
+                        help='run the reward/state/task decoders on separate CUDA streams (needs a GPU)')
 
     # - encoder
     parser.add_argument('--action_embedding_size', type=int, default=16)
@@ -234,11 +234,10 @@ class MetaLearner:
                 latent_sample, latent_mean, latent_logvar, hidden_state = self.encode_running_trajectory()
 
             # add this initial hidden state to the policy storage
-            assert len(self.policy_storage.latent_mean) == 0  # make sure we emptied buffers
             self.policy_storage.hidden_states[0].copy_(hidden_state)
-            self.policy_storage.latent_samples.append(latent_sample.clone())
-            self.policy_storage.latent_mean.append(latent_mean.clone())
-            self.policy_storage.latent_logvar.append(latent_logvar.clone())
+            self.policy_storage.latent_samples[0].copy_(latent_sample)
+            self.policy_storage.latent_mean[0].copy_(latent_mean)
+            self.policy_storage.latent_logvar[0].copy_(latent_logvar)
 
             # rollout policies for a few steps
             for step in range(self.args.policy_num_steps):
@@ -567,10 +566,10 @@ class MetaLearner:
             self.logger.add('policy/action_logprob', run_stats[1].mean(), self.iter_idx)
             self.logger.add('policy/value', run_stats[2].mean(), self.iter_idx)
 
-            self.logger.add('encoder/latent_mean', torch.cat(self.policy_storage.latent_mean).mean(), self.iter_idx)
+            self.logger.add('encoder/latent_mean', self.policy_storage.latent_mean.mean(), self.iter_idx)
             self.logger.add('encoder/latent_mean_final_0', self.policy_storage.latent_mean[-1][:, 0].mean(), self.iter_idx)
             self.logger.add('encoder/latent_mean_final_1', self.policy_storage.latent_mean[-1][:, 1].mean(), self.iter_idx)
-            self.logger.add('encoder/latent_logvar', torch.cat(self.policy_storage.latent_logvar).mean(), self.iter_idx)
+            self.logger.add('encoder/latent_logvar', self.policy_storage.latent_logvar.mean(), self.iter_idx)
             self.logger.add('encoder/latent_logvar_final_0', self.policy_storage.latent_logvar[-1][:, 0].mean(), self.iter_idx)
             self.logger.add('encoder/latent_logvar_final_1', self.policy_storage.latent_logvar[-1][:, 1].mean(), self.iter_idx)
 
@@ -589,5 +588,6 @@ class MetaLearner:
                     if name == 'policy':
                         self.logger.add('weights/policy_std', param_list[0].data.mean(), self.iter_idx)
                     if param_list[0].grad is not None:
-                        param_grad_mean = np.mean([param_list[i].grad.cpu().numpy().mean() for i in range(len(param_list))])
+                        param_grad_mean = np.mean([param_list[i].grad.cpu().numpy().mean() for i in range(len(param_list))
+                                                   if param_list[i].grad is not None])
                         self.logger.add('gradients/{}'.format(name), param_grad_mean, self.iter_idx)
@@ -7,6 +7,18 @@ from utils import helpers as utl
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
+def cat_broadcast(tensors):
+    """
+    Concatenates along the last dimension, broadcasting all other dimensions.
+    (The VAE passes e.g. latents of shape [num_elbos x 1 x batch x dim] and states of shape
+    [1 x num_decodes x batch x dim], so the inputs are only expanded here, right before concatenating.)
+    Zero-width inputs (e.g. the empty tensor utl.FeatureExtractor returns for an embedding size of 0) are skipped.
+    """
+    tensors = [t for t in tensors if t.shape[-1] > 0]
+    batch_shape = torch.broadcast_tensors(*[t[..., 0] for t in tensors])[0].shape
+    return torch.cat([t.expand(*batch_shape, t.shape[-1]) for t in tensors], dim=-1)
+
+
 class StateTransitionDecoder(nn.Module):
     def __init__(self,
                  args,
@@ -44,7 +56,7 @@ class StateTransitionDecoder(nn.Module):
 
         ha = self.action_encoder(actions)
         hs = self.state_encoder(state)
-        h = torch.cat((latent_state, hs, ha), dim=-1)
+        h = cat_broadcast((latent_state, hs, ha))
 
         for i in range(len(self.fc_layers)):
             h = F.relu(self.fc_layers[i](h))
@@ -115,14 +127,12 @@ class RewardDecoder(nn.Module):
         if self.multi_head:
             h = latent_state.clone()
         else:
-            hns = self.state_encoder(next_state)
-            h = torch.cat((latent_state, hns), dim=-1)
+            h = [latent_state, self.state_encoder(next_state)]
             if self.input_action:
-                ha = self.action_encoder(actions)
-                h = torch.cat((h, ha), dim=-1)
+                h.append(self.action_encoder(actions))
             if self.input_prev_state:
-                hps = self.state_encoder(prev_state)
-                h = torch.cat((h, hps), dim=-1)
+                h.append(self.state_encoder(prev_state))
+            h = cat_broadcast(h)
 
         for i in range(len(self.fc_layers)):
             h = F.relu(self.fc_layers[i](h))
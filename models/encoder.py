@@ -123,12 +123,15 @@ class RNNEncoder(nn.Module):
 
         return latent_sample, latent_mean, latent_logvar, hidden_state
 
-    def forward(self, actions, states, rewards, hidden_state, return_prior, sample=True, detach_every=None):
+    def forward(self, actions, states, rewards, hidden_state, return_prior, sample=True, detach_every=None,
+                lengths=None):
         """
         Actions, states, rewards should be given in form [sequence_len * batch_size * dim].
         For one-step predictions, sequence_len=1 and hidden_state!=None.
         For feeding in entire trajectories, sequence_len>1 and hidden_state=None.
         In the latter case, we return embeddings of length sequence_len+1 since they include the prior.
+        If the (zero-padded) trajectories have different lengths, these can be passed as lengths so that the GRU
+        skips the padding; the outputs at the padded timesteps are then computed from a zero GRU output.
         """
 
         # we do the action-normalisation (the the env bounds) here
@@ -157,7 +160,13 @@ class RNNEncoder(nn.Module):
         for i in range(len(self.fc_before_gru)):
             h = F.relu(self.fc_before_gru[i](h))
 
-        if detach_every is None:
+        if lengths is not None and detach_every is None:
+            # GRU on the packed trajectories, so the padded timesteps are not computed
+            lengths = torch.as_tensor(np.asarray(lengths, dtype=np.int64))
+            packed_h = nn.utils.rnn.pack_padded_sequence(h, lengths, enforce_sorted=False)
+            output, _ = self.gru(packed_h, hidden_state)
+            output, _ = nn.utils.rnn.pad_packed_sequence(output, total_length=h.shape[0])
+        elif detach_every is None:
             # GRU cell (output is outputs for each time step, hidden_state is last output)
             output, _ = self.gru(h, hidden_state)
         else:
@@ -1,7 +1,8 @@
 """
 Based on https://github.com/ikostrikov/pytorch-a2c-ppo-acktr
 """
-import numpy as np
+import warnings
+
 import torch
 import torch.nn as nn
 
@@ -25,8 +26,6 @@ except ImportError:
           'Do not set norm_actions_pre_sampling, this will break.')
     pass
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
 
 class Policy(nn.Module):
     def __init__(self,
@@ -58,19 +57,18 @@ class Policy(nn.Module):
 
         self.args = args
 
-        if activation_function == 'tanh':
-            self.activation_function = nn.Tanh()
-        elif activation_function == 'relu':
-            self.activation_function = nn.ReLU()
-        elif activation_function == 'leaky-relu':
-            self.activation_function = nn.LeakyReLU()
-        else:
-            raise ValueError
+        self.activation_function = get_activation(activation_function)
 
+        gain = nn.init.calculate_gain(activation_function)
         if policy_initialisation == 'normc':
-            init_ = lambda m: init(m, init_normc_, lambda x: nn.init.constant_(x, 0), nn.init.calculate_gain(activation_function))
+            weight_init = init_normc_
         elif policy_initialisation == 'orthogonal':
-            init_ = lambda m: init(m, nn.init.orthogonal_, lambda x: nn.init.constant_(x, 0), nn.init.calculate_gain(activation_function))
+            weight_init = nn.init.orthogonal_
+        else:
+            raise ValueError(policy_initialisation)
+
+        def init_(m):
+            return init(m, weight_init, nn.init.zeros_, gain)
 
         self.pass_state_to_policy = pass_state_to_policy
         self.pass_latent_to_policy = pass_latent_to_policy
@@ -78,19 +76,28 @@ class Policy(nn.Module):
         self.pass_belief_to_policy = pass_belief_to_policy
 
         # set normalisation parameters for the inputs
-        # (will be updated from outside using the RL batches)
+        # (will be updated from outside using the RL batches;
+        # mean and 1/std are cached in buffers so the forward pass doesn't recompute them every step)
         self.norm_state = self.args.norm_state_for_policy and (dim_state is not None)
         if self.pass_state_to_policy and self.norm_state:
             self.state_rms = utl.RunningMeanStd(shape=(dim_state))
+            self.register_buffer('state_mean', torch.zeros(dim_state))
+            self.register_buffer('state_inv_std', torch.ones(dim_state))
         self.norm_latent = self.args.norm_latent_for_policy and (dim_latent is not None)
         if self.pass_latent_to_policy and self.norm_latent:
             self.latent_rms = utl.RunningMeanStd(shape=(dim_latent))
+            self.register_buffer('latent_mean', torch.zeros(dim_latent))
+            self.register_buffer('latent_inv_std', torch.ones(dim_latent))
         self.norm_belief = self.args.norm_belief_for_policy and (dim_belief is not None)
         if self.pass_belief_to_policy and self.norm_belief:
             self.belief_rms = utl.RunningMeanStd(shape=(dim_belief))
+            self.register_buffer('belief_mean', torch.zeros(dim_belief))
+            self.register_buffer('belief_inv_std', torch.ones(dim_belief))
         self.norm_task = self.args.norm_task_for_policy and (dim_task is not None)
         if self.pass_task_to_policy and self.norm_task:
             self.task_rms = utl.RunningMeanStd(shape=(dim_task))
+            self.register_buffer('task_mean', torch.zeros(dim_task))
+            self.register_buffer('task_inv_std', torch.ones(dim_task))
 
         curr_input_dim = dim_state * int(self.pass_state_to_policy) + \
                          dim_latent * int(self.pass_latent_to_policy) + \
@@ -114,16 +121,42 @@ class Policy(nn.Module):
             self.task_encoder = utl.FeatureExtractor(dim_task, self.args.policy_task_embedding_dim, self.activation_function)
             curr_input_dim = curr_input_dim - dim_task + self.args.policy_task_embedding_dim
 
+        # the inputs that are passed to the policy, with their normalisation/encoder settings
+        # (fixed at init, so the forward pass only loops over the inputs that are actually used)
+        self.policy_inputs = [(name, dim, norm, use_encoder) for (name, dim, passed, norm, use_encoder) in [
+            ('state', dim_state, self.pass_state_to_policy, self.norm_state, self.use_state_encoder),
+            ('latent', dim_latent, self.pass_latent_to_policy, self.norm_latent, self.use_latent_encoder),
+            ('belief', dim_belief, self.pass_belief_to_policy, self.norm_belief, self.use_belief_encoder),
+            ('task', dim_task, self.pass_task_to_policy, self.norm_task, self.use_task_encoder)]
+                              if passed]
+        self.use_input_encoder = any(use_encoder for (_, _, _, use_encoder) in self.policy_inputs)
+        self.normalised_inputs = [name for (name, _, norm, _) in self.policy_inputs if norm]
+
+        # without input encoders, the inputs are concatenated first and normalised in one go
+        # (inputs that aren't normalised keep mean 0 and 1/std 1 in the concatenated buffers)
+        if not self.use_input_encoder:
+            self.register_buffer('_cat_mean', torch.zeros(curr_input_dim))
+            self.register_buffer('_cat_inv_std', torch.ones(curr_input_dim))
+
         # initialise actor and critic
+        # (each is a single nn.Sequential, with a fresh in-place activation after every linear layer;
+        # with a shared trunk, actor and critic are the same network and only the output heads differ)
+        self.shared_trunk = hasattr(self.args, 'policy_shared_trunk') and self.args.policy_shared_trunk
         hidden_layers = [int(h) for h in hidden_layers]
-        self.actor_layers = nn.ModuleList()
-        self.critic_layers = nn.ModuleList()
+        actor_layers = []
+        critic_layers = []
         for i in range(len(hidden_layers)):
-            fc = init_(nn.Linear(curr_input_dim, hidden_layers[i]))
-            self.actor_layers.append(fc)
-            fc = init_(nn.Linear(curr_input_dim, hidden_layers[i]))
-            self.critic_layers.append(fc)
+            actor_layers.append(init_(nn.Linear(curr_input_dim, hidden_layers[i])))
+            actor_layers.append(get_activation(activation_function, inplace=True))
+            if not self.shared_trunk:
+                critic_layers.append(init_(nn.Linear(curr_input_dim, hidden_layers[i])))
+                critic_layers.append(get_activation(activation_function, inplace=True))
             curr_input_dim = hidden_layers[i]
+        self.actor = nn.Sequential(*actor_layers)
+        if self.shared_trunk:
+            self.critic = self.actor
+        else:
+            self.critic = nn.Sequential(*critic_layers)
         self.critic_linear = nn.Linear(hidden_layers[-1], 1)
 
         # output distributions of the policy
@@ -136,6 +169,45 @@ class Policy(nn.Module):
         else:
             raise NotImplementedError
 
+        # compile the actor/critic MLPs (fuses linear+activation, removes per-op dispatch overhead);
+        # the input shapes are fixed (batch size for acting / for the RL updates), so we specialise on them,
+        # and the value head is compiled separately so that the actor and critic graphs stay independent
+        if hasattr(self.args, 'policy_compile') and self.args.policy_compile:
+            if hasattr(torch, 'compile'):
+                mode = self.args.policy_compile_mode if hasattr(self.args, 'policy_compile_mode') else 'max-autotune'
+                self.forward_actor = torch.compile(self.forward_actor, mode=mode, dynamic=False)
+                self.forward_critic = torch.compile(self.forward_critic, mode=mode, dynamic=False)
+                self.forward_value = torch.compile(self.forward_value, mode=mode, dynamic=False)
+            else:
+                warnings.warn('torch.compile is not available in this PyTorch version, running the policy eagerly.')
+
+        # select actions in bfloat16 (the weights, and training, stay in float32)
+        self.bf16_inference = hasattr(self.args, 'policy_bf16_inference') and self.args.policy_bf16_inference
+        if self.bf16_inference and not (hasattr(torch, 'autocast') and torch.cuda.is_available()):
+            warnings.warn('bfloat16 autocast needs PyTorch 1.10+ and a GPU, selecting actions in float32.')
+            self.bf16_inference = False
+
+        # capture action selection in a CUDA graph (done lazily on the first call to act, for that input shape)
+        self.use_cuda_graph = hasattr(self.args, 'policy_cuda_graph') and self.args.policy_cuda_graph
+        if self.use_cuda_graph and not hasattr(torch.cuda, 'CUDAGraph'):
+            warnings.warn('CUDA graphs are not available in this PyTorch version, running the policy eagerly.')
+            self.use_cuda_graph = False
+        if self.use_cuda_graph and hasattr(self.args, 'policy_compile') and self.args.policy_compile:
+            warnings.warn('the compiled policy manages its own CUDA graphs, not capturing act separately.')
+            self.use_cuda_graph = False
+        self._graph = None
+
+    def __getstate__(self):
+        # compiled functions can't be pickled (we save the entire model), so the loaded model runs eagerly
+        state = self.__dict__.copy()
+        for name in ['forward_actor', 'forward_critic', 'forward_value']:
+            state.pop(name, None)
+        # same for the CUDA graph (it's captured again after loading)
+        for name in ['_graph_inputs', '_graph_outputs']:
+            state.pop(name, None)
+        state['_graph'] = None
+        return state
+
     def get_actor_params(self):
         return [*self.actor.parameters(), *self.dist.parameters()]
 
@@ -143,65 +215,129 @@ class Policy(nn.Module):
         return [*self.critic.parameters(), *self.critic_linear.parameters()]
 
     def forward_actor(self, inputs):
-        h = inputs
-        for i in range(len(self.actor_layers)):
-            h = self.actor_layers[i](h)
-            h = self.activation_function(h)
-        return h
+        return self.actor(inputs)
 
     def forward_critic(self, inputs):
-        h = inputs
-        for i in range(len(self.critic_layers)):
-            h = self.critic_layers[i](h)
-            h = self.activation_function(h)
-        return h
+        return self.critic(inputs)
+
+    def forward_value(self, hidden_critic):
+        return self.critic_linear(hidden_critic)
 
     def forward(self, state, latent, belief, task):
+        inputs = self._build_inputs(state, latent, belief, task)
 
-        # handle inputs (normalise + embed)
+        # forward through critic/actor part
+        if self.shared_trunk:
+            hidden = self.forward_actor(inputs)
+            return self.forward_value(hidden), hidden
+        hidden_critic = self.forward_critic(inputs)
+        hidden_actor = self.forward_actor(inputs)
+        return self.forward_value(hidden_critic), hidden_actor
 
-        if self.pass_state_to_policy:
-            if self.norm_state:
-                state = (state - self.state_rms.mean) / torch.sqrt(self.state_rms.var + 1e-8)
-            if self.use_state_encoder:
-                state = self.state_encoder(state)
-        else:
-            state = torch.zeros(0, ).to(device)
-        if self.pass_latent_to_policy:
-            if self.norm_latent:
-                latent = (latent - self.latent_rms.mean) / torch.sqrt(self.latent_rms.var + 1e-8)
-            if self.use_latent_encoder:
-                latent = self.latent_encoder(latent)
-        else:
-            latent = torch.zeros(0, ).to(device)
-        if self.pass_belief_to_policy:
-            if self.norm_belief:
-                belief = (belief - self.belief_rms.mean) / torch.sqrt(self.belief_rms.var + 1e-8)
-            if self.use_belief_encoder:
-                belief = self.belief_encoder(belief.float())
-        else:
-            belief = torch.zeros(0, ).to(device)
-        if self.pass_task_to_policy:
-            if self.norm_task:
-                task = (task - self.task_rms.mean) / torch.sqrt(self.task_rms.var + 1e-8)
-            if self.use_task_encoder:
-                task = self.task_encoder(task.float())
+    def _build_inputs(self, state, latent, belief, task):
+        """
+        Normalises, embeds and concatenates the policy inputs (shared by the actor and critic).
+        All inputs that are passed to the policy have to be float32 tensors on the policy's device already
+        (as produced by utl.reset_env / utl.env_step and the rollout storage); no casting happens here.
+        """
+
+        # handle inputs (normalise + embed)
+        inputs = {'state': state, 'latent': latent, 'belief': belief, 'task': task}
+
+        normalise_separately = self.use_input_encoder
+        if normalise_separately and len(self.normalised_inputs) > 1 and \
+                hasattr(torch, '_foreach_mul_') and not torch.is_grad_enabled():
+            inputs = self._normalise_inputs_foreach(inputs)
+            normalise_separately = False
+
+        features = []
+        for name, _, norm, use_encoder in self.policy_inputs:
+            x = inputs[name]
+            if norm and normalise_separately:
+                x = (x - getattr(self, name + '_mean')) * getattr(self, name + '_inv_std')
+            if use_encoder:
+                x = getattr(self, name + '_encoder')(x)
+            features.append(x)
+
+        # concatenate inputs (nothing to do if the policy only gets one input, e.g. just the state)
+        if len(features) == 1:
+            inputs = features[0]
         else:
-            task = torch.zeros(0, ).to(device)
+            inputs = torch.cat(features, dim=-1)
+        if not self.use_input_encoder and self.normalised_inputs:
+            inputs = (inputs - self._cat_mean) * self._cat_inv_std
 
-        # concatenate inputs
-        inputs = torch.cat((state, latent, belief, task), dim=-1)
+        return inputs
 
-        # forward through critic/actor part
-        hidden_critic = self.forward_critic(inputs)
-        hidden_actor = self.forward_actor(inputs)
-        return self.critic_linear(hidden_critic), hidden_actor
+    def _normalise_inputs_foreach(self, inputs):
+        """
+        Normalises all inputs with two multi-tensor ops (one kernel launch each instead of one per input).
+        Only used at inference time, since not all PyTorch versions support autograd for these ops.
+        """
+        inputs = dict(inputs)
+        xs = [inputs[name] for name in self.normalised_inputs]
+        means = [getattr(self, name + '_mean').expand_as(x) for name, x in zip(self.normalised_inputs, xs)]
+        inv_stds = [getattr(self, name + '_inv_std').expand_as(x) for name, x in zip(self.normalised_inputs, xs)]
+        # (out-of-place subtraction, so we don't overwrite the caller's tensors)
+        xs = torch._foreach_sub(xs, means)
+        torch._foreach_mul_(xs, inv_stds)
+        inputs.update(zip(self.normalised_inputs, xs))
+        return inputs
 
     def act(self, state, latent, belief, task, deterministic=False):
         """
         Returns the (raw) actions and their value.
+        Called once per environment step for all processes together: each input is either None
+        (if not passed to the policy) or a (num_processes, dim) tensor already on the policy's device,
+        and the returned value/action have shape (num_processes, 1) / (num_processes, action_dim).
+        Don't split the inputs per process; the actions are only split up by the vectorised envs.
         """
-        value, actor_features = self.forward(state=state, latent=latent, belief=belief, task=task)
+        if self.use_cuda_graph and not deterministic and not torch.is_grad_enabled():
+            inputs = (state, latent, belief, task)
+            if all(x is None or x.is_cuda for x in inputs):
+                if self._graph is None:
+                    self._capture_act_graph(inputs)
+                if self._graph_matches(inputs):
+                    for static_x, x in zip(self._graph_inputs, inputs):
+                        if x is not None:
+                            static_x.copy_(x)
+                    self._graph.replay()
+                    return self._graph_outputs[0].clone(), self._graph_outputs[1].clone()
+            # different input shapes (e.g. during evaluation): fall back to eager mode
+        return self._act(state, latent, belief, task, deterministic)
+
+    def _graph_matches(self, inputs):
+        for static_x, x in zip(self._graph_inputs, inputs):
+            if (static_x is None) != (x is None):
+                return False
+            if x is not None and (static_x.shape != x.shape or static_x.dtype != x.dtype):
+                return False
+        return True
+
+    def _capture_act_graph(self, inputs):
+        """ Captures forward pass + sampling in a CUDA graph, with static input/output tensors """
+        self._graph_inputs = [None if x is None else x.clone() for x in inputs]
+        # warm up on a side stream (as required before capturing)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._act(*self._graph_inputs, deterministic=False)
+        torch.cuda.current_stream().wait_stream(stream)
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._graph_outputs = self._act(*self._graph_inputs, deterministic=False)
+
+    def _act(self, state, latent, belief, task, deterministic):
+        if self.bf16_inference:
+            # (no weight-cast cache: under CUDA graph capture, the cached bf16 weights would be baked into the graph
+            # and replays would ignore later updates to the float32 weights)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, cache_enabled=False):
+                value, actor_features = self.forward(state=state, latent=latent, belief=belief, task=task)
+            # the action distribution (and hence the actions) are in float32
+            value, actor_features = value.float(), actor_features.float()
+        else:
+            value, actor_features = self.forward(state=state, latent=latent, belief=belief, task=task)
         dist = self.dist(actor_features)
         if deterministic:
             if isinstance(dist, FixedCategorical):
@@ -214,24 +350,41 @@ class Policy(nn.Module):
         return value, action
 
     def get_value(self, state, latent, belief, task):
-        value, _ = self.forward(state, latent, belief, task)
-        return value
+        # only the critic is needed here
+        inputs = self._build_inputs(state, latent, belief, task)
+        return self.forward_value(self.forward_critic(inputs))
 
     def update_rms(self, args, policy_storage):
         """ Update normalisation parameters for inputs with current data """
         if self.pass_state_to_policy and self.norm_state:
             self.state_rms.update(policy_storage.prev_state[:-1])
+            self.state_mean.copy_(self.state_rms.mean)
+            self.state_inv_std.copy_(torch.rsqrt(self.state_rms.var + 1e-8))
         if self.pass_latent_to_policy and self.norm_latent:
             latent = utl.get_latent_for_policy(args,
-                                               torch.cat(policy_storage.latent_samples[:-1]),
-                                               torch.cat(policy_storage.latent_mean[:-1]),
-                                               torch.cat(policy_storage.latent_logvar[:-1])
+                                               policy_storage.latent_samples[:-1],
+                                               policy_storage.latent_mean[:-1],
+                                               policy_storage.latent_logvar[:-1]
                                                )
             self.latent_rms.update(latent)
+            self.latent_mean.copy_(self.latent_rms.mean)
+            self.latent_inv_std.copy_(torch.rsqrt(self.latent_rms.var + 1e-8))
         if self.pass_belief_to_policy and self.norm_belief:
             self.belief_rms.update(policy_storage.beliefs[:-1])
+            self.belief_mean.copy_(self.belief_rms.mean)
+            self.belief_inv_std.copy_(torch.rsqrt(self.belief_rms.var + 1e-8))
         if self.pass_task_to_policy and self.norm_task:
             self.task_rms.update(policy_storage.tasks[:-1])
+            self.task_mean.copy_(self.task_rms.mean)
+            self.task_inv_std.copy_(torch.rsqrt(self.task_rms.var + 1e-8))
+        if not self.use_input_encoder and self.normalised_inputs:
+            # copy the per-input parameters into the buffers for the concatenated input
+            offset = 0
+            for name, dim, norm, _ in self.policy_inputs:
+                if norm:
+                    self._cat_mean[offset:offset + dim].copy_(getattr(self, name + '_mean'))
+                    self._cat_inv_std[offset:offset + dim].copy_(getattr(self, name + '_inv_std'))
+                offset += dim
 
     def evaluate_actions(self, state, latent, belief, task, action):
 
@@ -260,26 +413,39 @@ class Policy(nn.Module):
         return value, action_log_probs, dist_entropy
 
 
-FixedCategorical = torch.distributions.Categorical
+class FixedCategorical(torch.distributions.Categorical):
+    """ Categorical distribution with actions of shape (..., 1) """
+
+    def sample(self, sample_shape=torch.Size()):
+        return super().sample(sample_shape).unsqueeze(-1)
+
+    def log_probs(self, actions):
+        return self.log_prob(actions.squeeze(-1)).unsqueeze(-1)
+
+    def mode(self):
+        return self.probs.argmax(dim=-1, keepdim=True)
 
-old_sample = FixedCategorical.sample
-FixedCategorical.sample = lambda self: old_sample(self).unsqueeze(-1)
 
-log_prob_cat = FixedCategorical.log_prob
-FixedCategorical.log_probs = lambda self, actions: log_prob_cat(self, actions.squeeze(-1)).unsqueeze(-1)
+class FixedNormal(torch.distributions.Normal):
+    """ Normal distribution; log-probs and entropy are per action dimension (summed by the caller) """
 
-FixedCategorical.mode = lambda self: self.probs.argmax(dim=-1, keepdim=True)
+    def log_probs(self, actions):
+        return self.log_prob(actions)
 
-FixedNormal = torch.distributions.Normal
-log_prob_normal = FixedNormal.log_prob
-FixedNormal.log_probs = lambda self, actions: log_prob_normal(self, actions)
-#FixedNormal.log_probs = lambda self, actions: log_prob_normal(self, actions).sum(-1, keepdim=True)
+    def mode(self):
+        return self.mean
 
-entropy = FixedNormal.entropy
-FixedNormal.entropy = lambda self: entropy(self)
-#FixedNormal.entropy = lambda self: entropy(self).sum(-1)
 
-FixedNormal.mode = lambda self: self.mean
+def get_activation(activation_function, inplace=False):
+    """ Returns a new activation module (tanh, relu, leaky-relu); tanh has no in-place version """
+    if activation_function == 'tanh':
+        return nn.Tanh()
+    elif activation_function == 'relu':
+        return nn.ReLU(inplace=inplace)
+    elif activation_function == 'leaky-relu':
+        return nn.LeakyReLU(inplace=inplace)
+    else:
+        raise ValueError
 
 
 def init(module, weight_init, bias_init, gain=1.0):
@@ -307,7 +473,8 @@ class Categorical(nn.Module):
 
     def forward(self, x):
         x = self.linear(x)
-        return FixedCategorical(logits=x)
+        # (no argument validation: it syncs with the host, which isn't allowed while capturing a CUDA graph)
+        return FixedCategorical(logits=x, validate_args=False)
 
 
 class DiagGaussian(nn.Module):
@@ -319,17 +486,18 @@ class DiagGaussian(nn.Module):
                                lambda x: nn.init.constant_(x, 0))
 
         self.fc_mean = init_(nn.Linear(num_inputs, num_outputs))
-        self.logstd = nn.Parameter(np.log(torch.zeros(num_outputs) + init_std))
+        self.logstd = nn.Parameter(torch.log(torch.full((num_outputs,), float(init_std))))
         self.norm_actions_pre_sampling = norm_actions_pre_sampling
-        self.min_std = torch.tensor([1e-6]).to(device)
+        self.min_std = 1e-6
 
     def forward(self, x):
 
         action_mean = self.fc_mean(x)
         if self.norm_actions_pre_sampling:
             action_mean = torch.tanh(action_mean)
-        std = torch.max(self.min_std, self.logstd.exp())
-        dist = FixedNormal(action_mean, std)
+        std = self.logstd.exp().clamp_min(self.min_std)
+        # (no argument validation: it syncs with the host, which isn't allowed while capturing a CUDA graph)
+        dist = FixedNormal(action_mean, std, validate_args=False)
 
         return dist
 
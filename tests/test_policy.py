@@ -0,0 +1,68 @@
+import gym
+import numpy as np
+import pytest
+import torch
+
+from config.mujoco import args_cheetah_dir_varibad
+from models.policy import Policy
+
+
+def make_policy(rest_args):
+    args = args_cheetah_dir_varibad.get_args(rest_args)
+    # (set by main.py / the metalearner)
+    args.init_model_path = None
+    args.default_prior = True
+    args.state_dim = 3
+    action_space = gym.spaces.Box(low=-1, high=1, shape=(2,), dtype=np.float32)
+    policy = Policy(
+        args=args,
+        pass_state_to_policy=True,
+        pass_latent_to_policy=True,
+        pass_belief_to_policy=False,
+        pass_task_to_policy=False,
+        dim_state=args.state_dim,
+        dim_latent=args.latent_dim * 2,
+        dim_belief=0,
+        dim_task=0,
+        hidden_layers=args.policy_layers,
+        activation_function=args.policy_activation_function,
+        policy_initialisation=args.policy_initialisation,
+        action_space=action_space,
+        init_std=args.policy_init_std,
+    ).to('cuda')
+    return args, policy
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a GPU')
+@pytest.mark.parametrize('bf16_inference', [False, True])
+def test_cuda_graph_act_matches_eager_after_update(bf16_inference):
+    args, policy = make_policy(['--policy_cuda_graph', 'True', '--policy_bf16_inference', str(bf16_inference)])
+    assert policy.use_cuda_graph
+    num_processes = 4
+
+    def inputs():
+        return (torch.randn(num_processes, args.state_dim, device='cuda'),
+                torch.randn(num_processes, args.latent_dim * 2, device='cuda'), None, None)
+
+    # the first stochastic call captures the graph
+    with torch.no_grad():
+        policy.act(*inputs(), deterministic=False)
+    assert policy._graph is not None
+
+    # change the weights after capturing (in place, like the optimiser in the RL update)
+    optimiser = torch.optim.Adam(policy.parameters(), lr=0.1)
+    value, actor_features = policy(*inputs())
+    (value.sum() + actor_features.sum()).backward()
+    optimiser.step()
+    # (with a tiny std, the sampled actions are the mean of the action distribution)
+    with torch.no_grad():
+        policy.dist.logstd.fill_(-20.)
+
+    state, latent, belief, task = inputs()
+    with torch.no_grad():
+        graph_value, graph_action = policy.act(state, latent, belief, task, deterministic=False)
+        eager_value, eager_action = policy._act(state, latent, belief, task, deterministic=True)
+
+    tolerance = 1e-2 if bf16_inference else 1e-5
+    assert torch.allclose(graph_value, eager_value, atol=tolerance)
+    assert torch.allclose(graph_action, eager_action, atol=tolerance)
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from config.mujoco import args_cheetah_dir_varibad
+from vae import VaribadVAE, device
+
+
+class Logger:
+    def __init__(self):
+        self.logged = {}
+
+    def add(self, name, value, x_pos):
+        self.logged[name] = value
+
+
+def make_vae(rest_args, monkeypatch):
+    args = args_cheetah_dir_varibad.get_args(rest_args)
+    # (set by main.py / the metalearner)
+    args.init_model_path = None
+    args.default_prior = True
+    args.state_dim = 3
+    args.action_dim = 2
+    args.max_trajectory_len = 5
+    logger = Logger()
+    vae = VaribadVAE(args, logger, lambda: 0)
+
+    # a batch of 4 full-length trajectories
+    num_trajs, traj_len = 4, args.max_trajectory_len
+    batch = (torch.randn(traj_len, num_trajs, args.state_dim, device=device),
+             torch.randn(traj_len, num_trajs, args.state_dim, device=device),
+             torch.randn(traj_len, num_trajs, args.action_dim, device=device),
+             torch.randn(traj_len, num_trajs, 1, device=device),
+             None,
+             [traj_len] * num_trajs)
+    monkeypatch.setattr(vae.rollout_storage, 'ready_for_update', lambda: True)
+    monkeypatch.setattr(vae.rollout_storage, 'get_batch', lambda batchsize: batch)
+    return vae, logger
+
+
+@pytest.mark.parametrize('disable_kl_term', [False, True])
+def test_compute_vae_loss_with_disabled_decoder(disable_kl_term, monkeypatch):
+    # decode_reward is on, but --disable_decoder means no decoder is created or trained
+    vae, logger = make_vae(['--disable_decoder', 'True', '--decode_reward', 'True', '--decode_state', 'False',
+                            '--decode_task', 'False', '--disable_kl_term', str(disable_kl_term)], monkeypatch)
+    assert vae.reward_decoder is None
+
+    loss = vae.compute_vae_loss(update=True)
+
+    if disable_kl_term:
+        # nothing to train
+        assert loss == 0
+        assert logger.logged == {}
+    else:
+        # only the KL term
+        assert loss.requires_grad
+        assert set(logger.logged) == {'vae_losses/kl', 'vae_losses/sum'}
+        assert logger.logged['vae_losses/sum'] == pytest.approx(vae.args.kl_weight * logger.logged['vae_losses/kl'])
@@ -4,6 +4,7 @@ import pickle
 import random
 import warnings
 from distutils.util import strtobool
+from typing import Tuple
 
 import numpy as np
 import torch
@@ -212,16 +213,16 @@ def recompute_embeddings(
 
     if update_idx == 0:
         try:
-            assert (torch.cat(policy_storage.latent_mean) - torch.cat(latent_mean)).sum() == 0
-            assert (torch.cat(policy_storage.latent_logvar) - torch.cat(latent_logvar)).sum() == 0
+            assert (policy_storage.latent_mean - torch.stack(latent_mean)).sum() == 0
+            assert (policy_storage.latent_logvar - torch.stack(latent_logvar)).sum() == 0
         except AssertionError:
             warnings.warn('You are not recomputing the embeddings correctly!')
             import pdb
             pdb.set_trace()
 
-    policy_storage.latent_samples = latent_sample
-    policy_storage.latent_mean = latent_mean
-    policy_storage.latent_logvar = latent_logvar
+    policy_storage.latent_samples = torch.stack(latent_sample)
+    policy_storage.latent_mean = torch.stack(latent_mean)
+    policy_storage.latent_logvar = torch.stack(latent_logvar)
 
 
 class FeatureExtractor(nn.Module):
@@ -273,11 +274,7 @@ class RunningMeanStd(object):
         self.count = epsilon
 
     def update(self, x):
-        x = x.view((-1, x.shape[-1]))
-        batch_mean = x.mean(dim=0)
-        batch_var = x.var(dim=0)
-        batch_count = x.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
+        self.mean, self.var, self.count = update_mean_var_count_from_batch(self.mean, self.var, float(self.count), x)
 
     def update_from_moments(self, batch_mean, batch_var, batch_count):
         self.mean, self.var, self.count = update_mean_var_count_from_moments(
@@ -298,6 +295,26 @@ def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var,
     return new_mean, new_var, new_count
 
 
+@torch.jit.script
+def update_mean_var_count_from_batch(mean: torch.Tensor, var: torch.Tensor, count: float,
+                                     x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, float]:
+    # same as computing the batch moments and calling update_mean_var_count_from_moments,
+    # but scripted so the elementwise updates are fused
+    x = x.reshape(-1, x.shape[-1])
+    batch_mean = x.mean(dim=0)
+    batch_var = x.var(dim=0)
+    batch_count = float(x.shape[0])
+
+    delta = batch_mean - mean
+    tot_count = count + batch_count
+
+    new_mean = mean + delta * (batch_count / tot_count)
+    M2 = var * count + batch_var * batch_count + delta * delta * (count * batch_count / tot_count)
+    new_var = M2 / tot_count
+
+    return new_mean, new_var, tot_count
+
+
 def boolean_argument(value):
     """Convert a string value to boolean."""
     return bool(strtobool(value))
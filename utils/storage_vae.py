@@ -38,6 +38,10 @@ class RolloutStorageVAE(object):
                 self.tasks = None
             self.trajectory_lens = [0] * self.max_buffer_size
 
+        # pinned staging buffers for copying batches to the GPU (see get_batch)
+        self.staging = []
+        self.staging_copied = None
+
         # storage for each running process (stored on GPU)
         self.num_processes = num_processes
         self.curr_timestep = torch.zeros((num_processes)).long()  # count environment steps so we know where to insert
@@ -175,12 +179,18 @@ class RolloutStorageVAE(object):
         rollout_indices = np.random.choice(range(self.buffer_len), batchsize, replace=replace)
         # trajectory length of the individual rollouts we picked
         trajectory_lens = np.array(self.trajectory_lens)[rollout_indices]
+        # only return the timesteps up to the longest trajectory we picked (the rest is zero-padding for all of them)
+        batch_len = int(max(trajectory_lens))
+
+        if device.type == 'cuda':
+            prev_obs, next_obs, actions, rewards, tasks = self.gather_to_device(rollout_indices, batch_len)
+            return prev_obs, next_obs, actions, rewards, tasks, trajectory_lens
 
         # select the rollouts we want
-        prev_obs = self.prev_state[:, rollout_indices, :]
-        next_obs = self.next_state[:, rollout_indices, :]
-        actions = self.actions[:, rollout_indices, :]
-        rewards = self.rewards[:, rollout_indices, :]
+        prev_obs = self.prev_state[:batch_len, rollout_indices, :]
+        next_obs = self.next_state[:batch_len, rollout_indices, :]
+        actions = self.actions[:batch_len, rollout_indices, :]
+        rewards = self.rewards[:batch_len, rollout_indices, :]
         if self.tasks is not None:
             tasks = self.tasks[rollout_indices].to(device)
         else:
@@ -188,3 +198,40 @@ class RolloutStorageVAE(object):
 
         return prev_obs.to(device), next_obs.to(device), actions.to(device), \
                rewards.to(device), tasks, trajectory_lens
+
+    def gather_to_device(self, rollout_indices, batch_len):
+        """
+        Gathers the first batch_len timesteps of the selected rollouts into pinned CPU buffers
+        (re-used across batches) and copies them to the GPU asynchronously.
+        """
+        # the previous batch has to be out of the staging buffers before we overwrite them
+        if self.staging_copied is not None:
+            self.staging_copied.synchronize()
+
+        rollout_indices = torch.from_numpy(np.asarray(rollout_indices, dtype=np.int64))
+        # (trajectories are along dim=1, except for the tasks)
+        buffers = [(self.prev_state, 1), (self.next_state, 1), (self.actions, 1), (self.rewards, 1)]
+        if self.tasks is not None:
+            buffers.append((self.tasks, 0))
+
+        batch = []
+        for i, (buffer, dim) in enumerate(buffers):
+            shape = list(buffer.shape)
+            shape[dim] = len(rollout_indices)
+            if len(self.staging) <= i:
+                self.staging.append(None)
+            if self.staging[i] is None or list(self.staging[i].shape) != shape:
+                self.staging[i] = torch.empty(shape, dtype=buffer.dtype).pin_memory()
+            if dim == 1:
+                # (time is the first dimension, so these slices are contiguous)
+                torch.index_select(buffer[:batch_len], dim, rollout_indices, out=self.staging[i][:batch_len])
+                batch.append(self.staging[i][:batch_len].to(device, non_blocking=True))
+            else:
+                torch.index_select(buffer, dim, rollout_indices, out=self.staging[i])
+                batch.append(self.staging[i].to(device, non_blocking=True))
+        self.staging_copied = torch.cuda.Event()
+        self.staging_copied.record()
+
+        if self.tasks is None:
+            batch.append(None)
+        return batch
@@ -1,3 +1,6 @@
+import contextlib
+import inspect
+import math
 import warnings
 import os
 
@@ -15,6 +18,27 @@ from utils.storage_vae import RolloutStorageVAE
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
+@torch.jit.script
+def gaussian_kl(mu, logE, m, logS):
+    # KL(N(mu,E)||N(m,S)) = 0.5 * (log(|S|/|E|) - K + tr(S^-1 E) + (m-mu)^T S^-1 (m-mu))) for diagonal E, S
+    # (written as one sum over the latent dimensions, so that the elementwise ops are fused into one kernel)
+    diff = m - mu
+    return 0.5 * (logS - logE - 1. + torch.exp(logE - logS) + diff * diff * torch.exp(-logS)).sum(dim=-1)
+
+
+@torch.jit.script
+def standard_normal_kl(mu, logE):
+    # KL(N(mu,E)||N(0,I)) for diagonal E (scripted so that the elementwise ops are fused, as above)
+    return -0.5 * (1. + logE - mu * mu - torch.exp(logE)).sum(dim=-1)
+
+
+@torch.jit.script
+def mse_mean_lastdim(pred, target):
+    # squared error averaged over the last dimension (scripted so that sub/mul/mean are fused)
+    diff = pred - target
+    return (diff * diff).mean(dim=-1)
+
+
 class VaribadVAE:
     """
     VAE of VariBAD:
@@ -37,6 +61,54 @@ class VaribadVAE:
         # initialise the decoders (returns None for unused decoders)
         self.state_decoder, self.reward_decoder, self.task_decoder = self.initialise_decoder()
 
+        # compiled versions of the encoder (for the VAE update) and the decoders
+        # (kept separately, so that the modules themselves can still be saved/loaded as usual)
+        self.compiled_encoder = None
+        self.compiled_decoders = {}
+        if hasattr(self.args, 'vae_compile') and self.args.vae_compile:
+            if hasattr(torch, 'compile'):
+                # the encoder gets static shapes, with the trajectories zero-padded to a power of two
+                # (see get_update_encoder); the prior / hidden state initialisation causes a graph break, so no fullgraph
+                self.compiled_encoder = torch.compile(self.encoder, mode='reduce-overhead', dynamic=False)
+                self.raise_encoder_recompile_limit()
+                for decoder in [self.state_decoder, self.reward_decoder, self.task_decoder]:
+                    if decoder is not None:
+                        # (dynamic shapes, since the trajectory lengths / number of decodes can change)
+                        self.compiled_decoders[decoder] = torch.compile(decoder, mode='reduce-overhead', dynamic=True)
+            else:
+                warnings.warn('torch.compile is not available in this PyTorch version, running the VAE eagerly.')
+
+        # CUDA streams for running the (independent) decoders concurrently in compute_loss
+        self.decoder_streams = None
+        if hasattr(self.args, 'vae_overlap_decoders') and self.args.vae_overlap_decoders:
+            if torch.cuda.is_available():
+                self.decoder_streams = {name: torch.cuda.Stream() for name in ['reward', 'state', 'task']}
+            else:
+                warnings.warn('vae_overlap_decoders needs a GPU, running the decoders one after the other.')
+
+        # run the encoder and decoders in bfloat16 autocast (their outputs, and everything after, are float32)
+        self.use_bf16_autocast = hasattr(self.args, 'vae_bf16_autocast') and self.args.vae_bf16_autocast
+        if self.use_bf16_autocast and not (hasattr(torch, 'autocast') and torch.cuda.is_available()):
+            warnings.warn('bfloat16 autocast needs PyTorch 1.10+ and a GPU, training the VAE in float32.')
+            self.use_bf16_autocast = False
+
+        # zeros for the prior in the KL term (cached, re-allocated only if the batch shape changes)
+        self._kl_prior_zeros = None
+
+        # weights of the (reward, state, task, KL) terms in the VAE loss, kept on the device
+        # (plus a zero to stand in for the terms that are switched off)
+        self._loss_coeffs = torch.tensor([self.args.rew_loss_coeff, self.args.state_loss_coeff,
+                                          self.args.task_loss_coeff, self.args.kl_weight], device=device)
+        self._zero_loss = torch.zeros((), device=device)
+
+        # environment instance used to map states/tasks to IDs for the decoder targets
+        # (created once here, since making the environment is expensive)
+        if (self.args.decode_reward and self.args.multihead_for_reward) or \
+                (self.args.decode_task and self.args.task_pred_type == 'task_id'):
+            self._task_env = gym.make(self.args.env_name)
+        else:
+            self._task_env = None
+
         # initialise rollout storage for the VAE update
         # (this differs from the data that the on-policy RL algorithm uses)
         self.rollout_storage = RolloutStorageVAE(num_processes=self.args.num_processes,
@@ -50,15 +122,30 @@ class VaribadVAE:
                                                  )
 
         # initalise optimiser for the encoder and decoders
-        decoder_params = []
+        # (one parameter group for the encoder and one per decoder, so they can have different learning rates)
+        lr_encoder = self.args.lr_vae_enc if getattr(self.args, 'lr_vae_enc', None) is not None else self.args.lr_vae
+        lr_decoder = self.args.lr_vae_dec if getattr(self.args, 'lr_vae_dec', None) is not None else self.args.lr_vae
+        param_groups = [{'params': list(self.encoder.parameters()), 'lr': lr_encoder}]
         if not self.args.disable_decoder:
             if self.args.decode_reward:
-                decoder_params.extend(self.reward_decoder.parameters())
+                param_groups.append({'params': list(self.reward_decoder.parameters()), 'lr': lr_decoder})
             if self.args.decode_state:
-                decoder_params.extend(self.state_decoder.parameters())
+                param_groups.append({'params': list(self.state_decoder.parameters()), 'lr': lr_decoder})
             if self.args.decode_task:
-                decoder_params.extend(self.task_decoder.parameters())
-        self.optimiser_vae = torch.optim.Adam([*self.encoder.parameters(), *decoder_params], lr=self.args.lr_vae)
+                param_groups.append({'params': list(self.task_decoder.parameters()), 'lr': lr_decoder})
+        # (the VAE has many small parameter tensors, so we use a multi-tensor/fused Adam step where available)
+        adam_kwargs = {}
+        adam_args = inspect.signature(torch.optim.Adam).parameters
+        if torch.cuda.is_available() and 'fused' in adam_args:
+            adam_kwargs['fused'] = True
+        elif 'foreach' in adam_args:
+            adam_kwargs['foreach'] = True
+        self.optimiser_vae = torch.optim.Adam(param_groups, lr=self.args.lr_vae, **adam_kwargs)
+        # (reset gradients to None rather than zeroing them, where supported; backward then allocates them fresh)
+        if 'set_to_none' in inspect.signature(torch.optim.Optimizer.zero_grad).parameters:
+            self._zero_grad_kwargs = {'set_to_none': True}
+        else:
+            self._zero_grad_kwargs = {}
 
     def initialise_encoder(self):
         """ Initialises and returns an RNN encoder """
@@ -149,19 +236,65 @@ class VaribadVAE:
 
         return state_decoder, reward_decoder, task_decoder
 
+    def active_decoders(self):
+        """ Returns whether the (reward, state, task) decoders are trained (none of them with --disable_decoder) """
+        if self.args.disable_decoder:
+            return False, False, False
+        return self.args.decode_reward, self.args.decode_state, self.args.decode_task
+
+    def get_update_encoder(self, batch_len):
+        """ Returns the encoder for the VAE update, and the length to zero-pad the trajectories to for it """
+        if self.compiled_encoder is None:
+            return self.encoder, batch_len
+        # pad to the next power of two, so the encoder is only compiled for a few different lengths
+        padded_len = min(2 ** int(math.ceil(math.log2(batch_len))), self.args.max_trajectory_len)
+        return self.compiled_encoder, padded_len
+
+    def raise_encoder_recompile_limit(self):
+        """
+        Makes sure dynamo can keep one compiled encoder graph per input shape of the VAE update.
+        (The compiled graphs are cached per code object, i.e., for RNNEncoder.forward, and once the
+        recompile limit is hit, dynamo silently falls back to running the encoder eagerly.)
+        """
+        import torch._dynamo
+        # padded lengths 1, 2, 4, ..., max_trajectory_len
+        num_lengths = int(math.ceil(math.log2(self.args.max_trajectory_len))) + 1
+        # the batch grows in steps of num_processes until it reaches vae_batch_num_trajs
+        num_batchsizes = int(math.ceil(self.args.vae_batch_num_trajs / self.args.num_processes))
+        # packed (mixed trajectory lengths) and padded (equal lengths) encoder inputs
+        num_graphs = 2 * num_lengths * num_batchsizes
+        limit_name = 'recompile_limit' if hasattr(torch._dynamo.config, 'recompile_limit') else 'cache_size_limit'
+        if getattr(torch._dynamo.config, limit_name) < num_graphs:
+            setattr(torch._dynamo.config, limit_name, num_graphs)
+
+    def autocast(self):
+        """ bfloat16 autocast context if enabled (otherwise a no-op) """
+        if not self.use_bf16_autocast:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+    def run_decoder(self, decoder, *inputs):
+        """ Forward pass through a decoder (in bfloat16 autocast if enabled; the output is always float32) """
+        decoder = self.compiled_decoders.get(decoder, decoder)
+        if not self.use_bf16_autocast:
+            return decoder(*inputs)
+        with self.autocast():
+            output = decoder(*inputs)
+        return output.float()
+
     def compute_state_reconstruction_loss(self, latent, prev_obs, next_obs, action, return_predictions=False):
         """ Compute state reconstruction loss.
         (No reduction of loss along batch dimension is done here; sum/avg has to be done outside) """
 
-        state_pred = self.state_decoder(latent, prev_obs, action)
+        state_pred = self.run_decoder(self.state_decoder, latent, prev_obs, action)
 
         if self.args.state_pred_type == 'deterministic':
-            loss_state = (state_pred - next_obs).pow(2).mean(dim=-1)
+            loss_state = mse_mean_lastdim(state_pred, next_obs)
         elif self.args.state_pred_type == 'gaussian':  # TODO: untested!
-            state_pred_mean = state_pred[:, :state_pred.shape[1] // 2]
-            state_pred_std = torch.exp(0.5 * state_pred[:, state_pred.shape[1] // 2:])
-            m = torch.distributions.normal.Normal(state_pred_mean, state_pred_std)
-            loss_state = -m.log_prob(next_obs).mean(dim=-1)
+            # negative log-likelihood of a diagonal Gaussian (the decoder outputs mean and log-variance)
+            state_pred_mean, state_pred_logvar = state_pred.chunk(2, dim=-1)
+            diff = (next_obs - state_pred_mean) * torch.exp(-0.5 * state_pred_logvar)
+            loss_state = (0.5 * diff.pow(2) + 0.5 * state_pred_logvar + 0.5 * math.log(2 * math.pi)).mean(dim=-1)
         else:
             raise NotImplementedError
 
@@ -175,32 +308,37 @@ class VaribadVAE:
         (No reduction of loss along batch dimension is done here; sum/avg has to be done outside) """
 
         if self.args.multihead_for_reward:
-            rew_pred = self.reward_decoder(latent, None)
+            rew_pred = self.run_decoder(self.reward_decoder, latent, None)
             if self.args.rew_pred_type == 'categorical':
                 rew_pred = F.softmax(rew_pred, dim=-1)
-            elif self.args.rew_pred_type == 'bernoulli':
-                rew_pred = torch.sigmoid(rew_pred)
+            # (for bernoulli, we keep the logits and only use the head of the selected state, see below)
 
-            env = gym.make(self.args.env_name)
-            state_indices = env.task_to_id(next_obs).to(device)
+            state_indices = self._task_env.task_to_id(next_obs).to(device)
             if state_indices.dim() < rew_pred.dim():
                 state_indices = state_indices.unsqueeze(-1)
-            rew_pred = rew_pred.gather(dim=-1, index=state_indices)
-            rew_target = (reward == 1).float()
+            # the latent may be broadcast over the decodes (and the states over the ELBO terms),
+            # so bring predictions and indices to a common shape before selecting the head for each state
+            batch_shape = torch.broadcast_tensors(rew_pred[..., 0], state_indices[..., 0])[0].shape
+            rew_pred = rew_pred.expand(*batch_shape, rew_pred.shape[-1])
+            rew_pred = rew_pred.gather(dim=-1, index=state_indices.expand(*batch_shape, 1))
+            rew_target = (reward == 1).float().expand_as(rew_pred)
             if self.args.rew_pred_type == 'deterministic':  # TODO: untested!
-                loss_rew = (rew_pred - reward).pow(2).mean(dim=-1)
-            elif self.args.rew_pred_type in ['categorical', 'bernoulli']:
+                loss_rew = mse_mean_lastdim(rew_pred, reward)
+            elif self.args.rew_pred_type == 'categorical':
                 loss_rew = F.binary_cross_entropy(rew_pred, rew_target, reduction='none').mean(dim=-1)
+            elif self.args.rew_pred_type == 'bernoulli':
+                loss_rew = F.binary_cross_entropy_with_logits(rew_pred, rew_target, reduction='none').mean(dim=-1)
+                rew_pred = torch.sigmoid(rew_pred)
             else:
                 raise NotImplementedError
         else:
-            rew_pred = self.reward_decoder(latent, next_obs, prev_obs, action.float())
+            rew_pred = self.run_decoder(self.reward_decoder, latent, next_obs, prev_obs, action.float())
             if self.args.rew_pred_type == 'bernoulli':  # TODO: untested!
+                rew_target = (reward == 1).float().expand_as(rew_pred)  # TODO: necessary?
+                loss_rew = F.binary_cross_entropy_with_logits(rew_pred, rew_target, reduction='none').mean(dim=-1)
                 rew_pred = torch.sigmoid(rew_pred)
-                rew_target = (reward == 1).float()  # TODO: necessary?
-                loss_rew = F.binary_cross_entropy(rew_pred, rew_target, reduction='none').mean(dim=-1)
             elif self.args.rew_pred_type == 'deterministic':
-                loss_rew = (rew_pred - reward).pow(2).mean(dim=-1)
+                loss_rew = mse_mean_lastdim(rew_pred, reward)
             else:
                 raise NotImplementedError
 
@@ -213,17 +351,16 @@ class VaribadVAE:
         """ Compute task reconstruction loss.
         (No reduction of loss along batch dimension is done here; sum/avg has to be done outside) """
 
-        task_pred = self.task_decoder(latent)
+        task_pred = self.run_decoder(self.task_decoder, latent)
 
         if self.args.task_pred_type == 'task_id':
-            env = gym.make(self.args.env_name)
-            task_target = env.task_to_id(task).to(device)
+            task_target = self._task_env.task_to_id(task).to(device)
             # expand along first axis (number of ELBO terms)
             task_target = task_target.expand(task_pred.shape[:-1]).reshape(-1)
             loss_task = F.cross_entropy(task_pred.view(-1, task_pred.shape[-1]),
                                         task_target, reduction='none').view(task_pred.shape[:-1])
         elif self.args.task_pred_type == 'task_description':
-            loss_task = (task_pred - task).pow(2).mean(dim=-1)
+            loss_task = mse_mean_lastdim(task_pred, task)
         else:
             raise NotImplementedError
 
@@ -235,29 +372,66 @@ class VaribadVAE:
     def compute_kl_loss(self, latent_mean, latent_logvar, elbo_indices):
         # -- KL divergence
         if self.args.kl_to_gauss_prior:
-            kl_divergences = (- 0.5 * (1 + latent_logvar - latent_mean.pow(2) - latent_logvar.exp()).sum(dim=-1))
+            kl_divergences = standard_normal_kl(latent_mean, latent_logvar)
         else:
-            gauss_dim = latent_mean.shape[-1]
             # add the gaussian prior
-            all_means = torch.cat((torch.zeros(1, *latent_mean.shape[1:]).to(device), latent_mean))
-            all_logvars = torch.cat((torch.zeros(1, *latent_logvar.shape[1:]).to(device), latent_logvar))
+            shape = (1, *latent_mean.shape[1:])
+            if self._kl_prior_zeros is None or self._kl_prior_zeros.shape != shape or \
+                    self._kl_prior_zeros.dtype != latent_mean.dtype:
+                self._kl_prior_zeros = torch.zeros(shape, device=latent_mean.device, dtype=latent_mean.dtype)
+            all_means = torch.cat((self._kl_prior_zeros, latent_mean))
+            all_logvars = torch.cat((self._kl_prior_zeros, latent_logvar))
             # https://arxiv.org/pdf/1811.09975.pdf
-            # KL(N(mu,E)||N(m,S)) = 0.5 * (log(|S|/|E|) - K + tr(S^-1 E) + (m-mu)^T S^-1 (m-mu)))
-            mu = all_means[1:]
-            m = all_means[:-1]
-            logE = all_logvars[1:]
-            logS = all_logvars[:-1]
-            kl_divergences = 0.5 * (torch.sum(logS, dim=-1) - torch.sum(logE, dim=-1) - gauss_dim + torch.sum(
-                1 / torch.exp(logS) * torch.exp(logE), dim=-1) + ((m - mu) / torch.exp(logS) * (m - mu)).sum(dim=-1))
+            kl_divergences = gaussian_kl(mu=all_means[1:], logE=all_logvars[1:], m=all_means[:-1], logS=all_logvars[:-1])
 
         # returns, for each ELBO_t term, one KL (so H+1 kl's)
         if elbo_indices is not None:
             batchsize = kl_divergences.shape[-1]
-            task_indices = torch.arange(batchsize).repeat(self.args.vae_subsample_elbos)
+            task_indices = torch.arange(batchsize, device=kl_divergences.device).repeat(self.args.vae_subsample_elbos)
             kl_divergences = kl_divergences[elbo_indices, task_indices].reshape((self.args.vae_subsample_elbos, batchsize))
 
         return kl_divergences
 
+    def decoder_stream(self, name, inputs):
+        """ Context for computing a decoder loss on its own CUDA stream (no-op if vae_overlap_decoders is off) """
+        if self.decoder_streams is None:
+            return torch.cuda.stream(None)
+        stream = self.decoder_streams[name]
+        # the inputs were produced on the current stream; don't let the allocator re-use them too early
+        stream.wait_stream(torch.cuda.current_stream())
+        for x in inputs:
+            x.record_stream(stream)
+        return torch.cuda.stream(stream)
+
+    def join_decoder_streams(self, losses):
+        """ Makes the current stream wait for the decoder streams before the losses are used """
+        if self.decoder_streams is None:
+            return
+        current_stream = torch.cuda.current_stream()
+        for stream in self.decoder_streams.values():
+            current_stream.wait_stream(stream)
+        for loss in losses:
+            if torch.is_tensor(loss):
+                loss.record_stream(current_stream)
+
+    def reduce_elbo_and_reconstruction_terms(self, loss):
+        """ Avg/sum a [num_elbo_terms] x [num_reconstruction_terms] x [num_tasks] loss over the ELBO and
+        reconstruction terms, and average across tasks """
+        # (a single reduction; averaging is a division by the number of terms)
+        divisor = loss.shape[2]
+        if self.args.vae_avg_elbo_terms:
+            divisor *= loss.shape[0]
+        if self.args.vae_avg_reconstruction_terms:
+            divisor *= loss.shape[1]
+        return loss.sum() / divisor
+
+    def reduce_elbo_terms(self, loss):
+        """ Avg/sum a [num_elbo_terms] x [num_tasks] loss over the ELBO terms, and sum across tasks """
+        # (a single reduction, as above)
+        if self.args.vae_avg_elbo_terms:
+            return loss.sum() / loss.shape[0]
+        return loss.sum()
+
     def compute_loss(self, latent_mean, latent_logvar, vae_prev_obs, vae_next_obs, vae_actions,
                      vae_rewards, vae_tasks, trajectory_lens):
         """
@@ -266,7 +440,8 @@ class VaribadVAE:
         (Important because we need to separate ELBOs and decoding terms so can't collapse those dimensions)
         """
 
-        num_unique_trajectory_lens = len(np.unique(trajectory_lens))
+        unique_trajectory_lens = np.unique(trajectory_lens)
+        num_unique_trajectory_lens = len(unique_trajectory_lens)
 
         assert (num_unique_trajectory_lens == 1) or (self.args.vae_subsample_elbos and self.args.vae_subsample_decodes)
         assert not self.args.decode_only_past
@@ -274,7 +449,7 @@ class VaribadVAE:
         # cut down the batch to the longest trajectory length
         # this way we can preserve the structure
         # but we will waste some computation on zero-padded trajectories that are shorter than max_traj_len
-        max_traj_len = np.max(trajectory_lens)
+        max_traj_len = unique_trajectory_lens[-1]
         latent_mean = latent_mean[:max_traj_len + 1]
         latent_logvar = latent_logvar[:max_traj_len + 1]
         vae_prev_obs = vae_prev_obs[:max_traj_len]
@@ -282,115 +457,110 @@ class VaribadVAE:
         vae_actions = vae_actions[:max_traj_len]
         vae_rewards = vae_rewards[:max_traj_len]
 
+        # which decoders to run (if none, only the KL term is computed and we skip preparing the decoder inputs)
+        decode_reward, decode_state, decode_task = self.active_decoders()
+        decode_any = decode_reward or decode_state or decode_task
+
         # take one sample for each ELBO term
-        if not self.args.disable_stochasticity_in_latent:
+        if not decode_any:
+            latent_samples = None
+        elif not self.args.disable_stochasticity_in_latent:
             latent_samples = self.encoder._sample_gaussian(latent_mean, latent_logvar)
         else:
             latent_samples = torch.cat((latent_mean, latent_logvar), dim=-1)
 
-        num_elbos = latent_samples.shape[0]
+        num_elbos = latent_mean.shape[0]
         num_decodes = vae_prev_obs.shape[0]
-        batchsize = latent_samples.shape[1]  # number of trajectories
+        batchsize = latent_mean.shape[1]  # number of trajectories
 
         # subsample elbo terms
         #   shape before: num_elbos * batchsize * dim
         #   shape after: vae_subsample_elbos * batchsize * dim
+        # (the index tensors are created on the device of the data they index, to avoid copying them there every time)
         if self.args.vae_subsample_elbos is not None:
             # randomly choose which elbo's to subsample
             if num_unique_trajectory_lens == 1:
-                elbo_indices = torch.LongTensor(self.args.vae_subsample_elbos * batchsize).random_(0, num_elbos)    # select diff elbos for each task
+                elbo_indices = torch.randint(0, num_elbos, (self.args.vae_subsample_elbos * batchsize,), device=device)    # select diff elbos for each task
             else:
                 # if we have different trajectory lengths, subsample elbo indices separately
                 # up to their maximum possible encoding length;
-                # only allow duplicates if the sample size would be larger than the number of samples
-                elbo_indices = np.concatenate([np.random.choice(range(0, t + 1), self.args.vae_subsample_elbos,
-                                                                replace=self.args.vae_subsample_elbos > (t+1)) for t in trajectory_lens])
+                # only allow duplicates if the sample size would be larger than the number of samples;
+                # (stacked along dim 1 so the flattened indices cycle through the trajectories, like task_indices)
+                elbo_indices = np.stack([np.random.choice(range(0, t + 1), self.args.vae_subsample_elbos,
+                                                          replace=self.args.vae_subsample_elbos > (t+1)) for t in trajectory_lens],
+                                        axis=1).reshape(-1)
+                elbo_indices = torch.from_numpy(elbo_indices).to(device)
                 if max_traj_len < self.args.vae_subsample_elbos:
                     warnings.warn('The required number of ELBOs is larger than the shortest trajectory, '
                                   'so there will be duplicates in your batch.'
                                   'To avoid this use --split_batches_by_elbo or --split_batches_by_task.')
-            task_indices = torch.arange(batchsize).repeat(self.args.vae_subsample_elbos)  # for selection mask
-            latent_samples = latent_samples[elbo_indices, task_indices, :].reshape((self.args.vae_subsample_elbos, batchsize, -1))
-            num_elbos = latent_samples.shape[0]
+            if decode_any:
+                task_indices = torch.arange(batchsize, device=device).repeat(self.args.vae_subsample_elbos)  # for selection mask
+                latent_samples = latent_samples[elbo_indices, task_indices, :].reshape((self.args.vae_subsample_elbos, batchsize, -1))
+            num_elbos = self.args.vae_subsample_elbos
         else:
             elbo_indices = None
 
-        # expand the state/rew/action inputs to the decoder (to match size of latents)
-        # shape will be: [num tasks in batch] x [num elbos] x [len trajectory (reconstrution loss)] x [dimension]
-        dec_prev_obs = vae_prev_obs.unsqueeze(0).expand((num_elbos, *vae_prev_obs.shape))
-        dec_next_obs = vae_next_obs.unsqueeze(0).expand((num_elbos, *vae_next_obs.shape))
-        dec_actions = vae_actions.unsqueeze(0).expand((num_elbos, *vae_actions.shape))
-        dec_rewards = vae_rewards.unsqueeze(0).expand((num_elbos, *vae_rewards.shape))
+        # add a dimension for the ELBO terms to the state/rew/action inputs to the decoder
+        # (we don't expand them to the number of latents; the decoders broadcast their inputs,
+        # so the state/action embeddings are only computed once for all ELBO terms)
+        # shape will be: 1 x [len trajectory (reconstrution loss)] x [num tasks in batch] x [dimension]
+        dec_prev_obs = vae_prev_obs.unsqueeze(0)
+        dec_next_obs = vae_next_obs.unsqueeze(0)
+        dec_actions = vae_actions.unsqueeze(0)
+        dec_rewards = vae_rewards.unsqueeze(0)
 
         # subsample reconstruction terms
-        if self.args.vae_subsample_decodes is not None:
+        if decode_any and self.args.vae_subsample_decodes is not None:
             # shape before: vae_subsample_elbos * num_decodes * batchsize * dim
             # shape after: vae_subsample_elbos * vae_subsample_decodes * batchsize * dim
             # (Note that this will always have duplicates given how we set up the code)
-            indices0 = torch.arange(num_elbos).repeat(self.args.vae_subsample_decodes * batchsize)
+            # (the inputs are the same for all ELBO terms, so we only index the decode and task dimensions)
             if num_unique_trajectory_lens == 1:
-                indices1 = torch.LongTensor(num_elbos * self.args.vae_subsample_decodes * batchsize).random_(0, num_decodes)
-            else:
-                indices1 = np.concatenate([np.random.choice(range(0, t), num_elbos * self.args.vae_subsample_decodes,
-                                                            replace=True) for t in trajectory_lens])
-            indices2 = torch.arange(batchsize).repeat(num_elbos * self.args.vae_subsample_decodes)
-            dec_prev_obs = dec_prev_obs[indices0, indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
-            dec_next_obs = dec_next_obs[indices0, indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
-            dec_actions = dec_actions[indices0, indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
-            dec_rewards = dec_rewards[indices0, indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
-            num_decodes = dec_prev_obs.shape[1]
-
-        # expand the latent (to match the number of state/rew/action inputs to the decoder)
-        # shape will be: [num tasks in batch] x [num elbos] x [len trajectory (reconstrution loss)] x [dimension]
-        dec_embedding = latent_samples.unsqueeze(0).expand((num_decodes, *latent_samples.shape)).transpose(1, 0)
-
-        if self.args.decode_reward:
-            # compute reconstruction loss for this trajectory (for each timestep that was encoded, decode everything and sum it up)
-            # shape: [num_elbo_terms] x [num_reconstruction_terms] x [num_trajectories]
-            rew_reconstruction_loss = self.compute_rew_reconstruction_loss(dec_embedding, dec_prev_obs, dec_next_obs,
-                                                                           dec_actions, dec_rewards)
-            # avg/sum across individual ELBO terms
-            if self.args.vae_avg_elbo_terms:
-                rew_reconstruction_loss = rew_reconstruction_loss.mean(dim=0)
-            else:
-                rew_reconstruction_loss = rew_reconstruction_loss.sum(dim=0)
-            # avg/sum across individual reconstruction terms
-            if self.args.vae_avg_reconstruction_terms:
-                rew_reconstruction_loss = rew_reconstruction_loss.mean(dim=0)
+                indices1 = torch.randint(0, num_decodes, (num_elbos * self.args.vae_subsample_decodes * batchsize,), device=device)
             else:
-                rew_reconstruction_loss = rew_reconstruction_loss.sum(dim=0)
-            # average across tasks
-            rew_reconstruction_loss = rew_reconstruction_loss.mean()
+                # (stacked along dim 1 so the flattened indices cycle through the trajectories, like indices2)
+                indices1 = np.stack([np.random.choice(range(0, t), num_elbos * self.args.vae_subsample_decodes,
+                                                      replace=True) for t in trajectory_lens], axis=1).reshape(-1)
+                indices1 = torch.from_numpy(indices1).to(device)
+            indices2 = torch.arange(batchsize, device=device).repeat(num_elbos * self.args.vae_subsample_decodes)
+            dec_prev_obs = vae_prev_obs[indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
+            dec_next_obs = vae_next_obs[indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
+            dec_actions = vae_actions[indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
+            dec_rewards = vae_rewards[indices1, indices2, :].reshape((num_elbos, self.args.vae_subsample_decodes, batchsize, -1))
+
+        # add a dimension for the decodes to the latent (broadcast to the state/rew/action inputs inside the decoder)
+        # shape will be: [num elbos] x 1 x [num tasks in batch] x [dimension]
+        dec_embedding = latent_samples.unsqueeze(1) if decode_any else None
+
+        # (the decoders are independent of each other, so with vae_overlap_decoders they run on separate CUDA streams)
+        dec_inputs = [dec_embedding, dec_prev_obs, dec_next_obs, dec_actions, dec_rewards]
+
+        if decode_reward:
+            with self.decoder_stream('reward', dec_inputs):
+                # compute reconstruction loss for this trajectory (for each timestep that was encoded, decode everything and sum it up)
+                # shape: [num_elbo_terms] x [num_reconstruction_terms] x [num_trajectories]
+                rew_reconstruction_loss = self.compute_rew_reconstruction_loss(dec_embedding, dec_prev_obs, dec_next_obs,
+                                                                               dec_actions, dec_rewards)
+                # avg/sum across individual ELBO terms and reconstruction terms, average across tasks
+                rew_reconstruction_loss = self.reduce_elbo_and_reconstruction_terms(rew_reconstruction_loss)
         else:
             rew_reconstruction_loss = 0
 
-        if self.args.decode_state:
-            state_reconstruction_loss = self.compute_state_reconstruction_loss(dec_embedding, dec_prev_obs,
-                                                                               dec_next_obs, dec_actions)
-            # avg/sum across individual ELBO terms
-            if self.args.vae_avg_elbo_terms:
-                state_reconstruction_loss = state_reconstruction_loss.mean(dim=0)
-            else:
-                state_reconstruction_loss = state_reconstruction_loss.sum(dim=0)
-            # avg/sum across individual reconstruction terms
-            if self.args.vae_avg_reconstruction_terms:
-                state_reconstruction_loss = state_reconstruction_loss.mean(dim=0)
-            else:
-                state_reconstruction_loss = state_reconstruction_loss.sum(dim=0)
-            # average across tasks
-            state_reconstruction_loss = state_reconstruction_loss.mean()
+        if decode_state:
+            with self.decoder_stream('state', dec_inputs):
+                state_reconstruction_loss = self.compute_state_reconstruction_loss(dec_embedding, dec_prev_obs,
+                                                                                   dec_next_obs, dec_actions)
+                # avg/sum across individual ELBO terms and reconstruction terms, average across tasks
+                state_reconstruction_loss = self.reduce_elbo_and_reconstruction_terms(state_reconstruction_loss)
         else:
             state_reconstruction_loss = 0
 
-        if self.args.decode_task:
-            task_reconstruction_loss = self.compute_task_reconstruction_loss(latent_samples, vae_tasks)
-            # avg/sum across individual ELBO terms
-            if self.args.vae_avg_elbo_terms:
-                task_reconstruction_loss = task_reconstruction_loss.mean(dim=0)
-            else:
-                task_reconstruction_loss = task_reconstruction_loss.sum(dim=0)
-            # sum the elbos, average across tasks
-            task_reconstruction_loss = task_reconstruction_loss.sum(dim=0).mean()
+        if decode_task:
+            with self.decoder_stream('task', [latent_samples, vae_tasks]):
+                task_reconstruction_loss = self.compute_task_reconstruction_loss(latent_samples, vae_tasks)
+                # avg/sum across individual ELBO terms, sum across tasks
+                task_reconstruction_loss = self.reduce_elbo_terms(task_reconstruction_loss)
         else:
             task_reconstruction_loss = 0
 
@@ -398,16 +568,13 @@ class VaribadVAE:
             # compute the KL term for each ELBO term of the current trajectory
             # shape: [num_elbo_terms] x [num_trajectories]
             kl_loss = self.compute_kl_loss(latent_mean, latent_logvar, elbo_indices)
-            # avg/sum the elbos
-            if self.args.vae_avg_elbo_terms:
-                kl_loss = kl_loss.mean(dim=0)
-            else:
-                kl_loss = kl_loss.sum(dim=0)
-            # average across tasks
-            kl_loss = kl_loss.sum(dim=0).mean()
+            # avg/sum the elbos, sum across tasks
+            kl_loss = self.reduce_elbo_terms(kl_loss)
         else:
             kl_loss = 0
 
+        self.join_decoder_streams([rew_reconstruction_loss, state_reconstruction_loss, task_reconstruction_loss])
+
         return rew_reconstruction_loss, state_reconstruction_loss, task_reconstruction_loss, kl_loss
 
     def compute_loss_split_batches_by_elbo(self, latent_mean, latent_logvar, vae_prev_obs, vae_next_obs, vae_actions,
@@ -423,8 +590,11 @@ class VaribadVAE:
         state_reconstruction_loss = []
         task_reconstruction_loss = []
 
-        assert len(np.unique(trajectory_lens)) == 1
-        n_horizon = np.unique(trajectory_lens)[0]
+        decode_reward, decode_state, decode_task = self.active_decoders()
+
+        unique_trajectory_lens = np.unique(trajectory_lens)
+        assert len(unique_trajectory_lens) == 1
+        n_horizon = unique_trajectory_lens[0]
         n_elbos = latent_mean.shape[0]  # includes the prior
 
         # for each elbo term (including one for the prior)...
@@ -443,8 +613,8 @@ class VaribadVAE:
             # if the size of what we decode is always the same, we can speed up creating the batches
             if not self.args.decode_only_past:
 
-                # expand the latent to match the (x, y) pairs of the decoder
-                dec_embedding = curr_samples.unsqueeze(0).expand((n_horizon, *curr_samples.shape))
+                # add a dimension for the (x, y) pairs of the decoder (the decoder broadcasts the latent)
+                dec_embedding = curr_samples.unsqueeze(0)
                 dec_embedding_task = curr_samples
 
                 dec_prev_obs = vae_prev_obs
@@ -471,7 +641,7 @@ class VaribadVAE:
 
                 # (1) ... get the latent sample after feeding in some data (determined by len_encoder) & expand (to number of outputs)
                 # num latent samples x embedding size
-                dec_embedding = curr_samples.unsqueeze(0).expand(dec_until - dec_from, *curr_samples.shape)
+                dec_embedding = curr_samples.unsqueeze(0)
                 dec_embedding_task = curr_samples
                 # (2) ... get the predictions for the trajectory until the timestep we're interested in
                 dec_prev_obs = vae_prev_obs[dec_from:dec_until]
@@ -479,7 +649,7 @@ class VaribadVAE:
                 dec_actions = vae_actions[dec_from:dec_until]
                 dec_rewards = vae_rewards[dec_from:dec_until]
 
-            if self.args.decode_reward:
+            if decode_reward:
                 # compute reconstruction loss for this trajectory (for each timestep that was encoded, decode everything and sum it up)
                 # size: if all trajectories are of same length [num_elbo_terms x num_reconstruction_terms], otherwise it's flattened into one
                 rrc = self.compute_rew_reconstruction_loss(dec_embedding, dec_prev_obs, dec_next_obs, dec_actions,
@@ -488,32 +658,32 @@ class VaribadVAE:
                 rrc = rrc.sum(dim=0).mean()
                 rew_reconstruction_loss.append(rrc)
 
-            if self.args.decode_state:
+            if decode_state:
                 src = self.compute_state_reconstruction_loss(dec_embedding, dec_prev_obs, dec_next_obs, dec_actions)
                 # sum up the reconstruction terms; average over tasks
                 src = src.sum(dim=0).mean()
                 state_reconstruction_loss.append(src)
 
-            if self.args.decode_task:
+            if decode_task:
                 trc = self.compute_task_reconstruction_loss(dec_embedding_task, vae_tasks)
                 # average across tasks
                 trc = trc.mean()
                 task_reconstruction_loss.append(trc)
 
         # sum the ELBO_t terms
-        if self.args.decode_reward:
+        if decode_reward:
             rew_reconstruction_loss = torch.stack(rew_reconstruction_loss)
             rew_reconstruction_loss = rew_reconstruction_loss.sum()
         else:
             rew_reconstruction_loss = 0
 
-        if self.args.decode_state:
+        if decode_state:
             state_reconstruction_loss = torch.stack(state_reconstruction_loss)
             state_reconstruction_loss = state_reconstruction_loss.sum()
         else:
             state_reconstruction_loss = 0
 
-        if self.args.decode_task:
+        if decode_task:
             task_reconstruction_loss = torch.stack(task_reconstruction_loss)
             task_reconstruction_loss = task_reconstruction_loss.sum()
         else:
@@ -544,19 +714,31 @@ class VaribadVAE:
         # vae_prev_obs will be of size: max trajectory len x num trajectories x dimension of observations
 
         # pass through encoder (outputs will be: (max_traj_len+1) x number of rollouts x latent_dim -- includes the prior!)
-        _, latent_mean, latent_logvar, _ = self.encoder(actions=vae_actions,
-                                                        states=vae_next_obs,
-                                                        rewards=vae_rewards,
-                                                        hidden_state=None,
-                                                        return_prior=True,
-                                                        detach_every=self.args.tbptt_stepsize if hasattr(self.args, 'tbptt_stepsize') else None,
-                                                        )
+        # (if the trajectories have different lengths, the encoder skips the zero-padding)
+        batch_len = vae_actions.shape[0]
+        encoder, padded_len = self.get_update_encoder(batch_len)
+        enc_actions, enc_next_obs, enc_rewards = vae_actions, vae_next_obs, vae_rewards
+        if padded_len > batch_len:
+            # (the encoder is causal, so the extra padding at the end doesn't change the latents we keep)
+            padding = (0, 0, 0, 0, 0, padded_len - batch_len)
+            enc_actions, enc_next_obs, enc_rewards = [F.pad(x, padding) for x in [vae_actions, vae_next_obs, vae_rewards]]
+        encoder_lengths = trajectory_lens if len(np.unique(trajectory_lens)) > 1 else None
+        with self.autocast():
+            _, latent_mean, latent_logvar, _ = encoder(actions=enc_actions,
+                                                       states=enc_next_obs,
+                                                       rewards=enc_rewards,
+                                                       hidden_state=None,
+                                                       return_prior=True,
+                                                       detach_every=self.args.tbptt_stepsize if hasattr(self.args, 'tbptt_stepsize') else None,
+                                                       lengths=encoder_lengths,
+                                                       )
+        # (the latents, and therefore the KL term and the decoder inputs, are float32)
+        latent_mean, latent_logvar = latent_mean[:batch_len + 1].float(), latent_logvar[:batch_len + 1].float()
 
         if self.args.split_batches_by_task:
-            raise NotImplementedError
-            losses = self.compute_loss_split_batches_by_task(latent_mean, latent_logvar, vae_prev_obs, vae_next_obs,
-                                                             vae_actions, vae_rewards, vae_tasks,
-                                                             trajectory_lens, len_encoder)
+            # (the default compute_loss already decodes all tasks in the batch in a single call)
+            raise NotImplementedError('split_batches_by_task is not supported, '
+                                      'use the default batched loss or split_batches_by_elbo.')
         elif self.args.split_batches_by_elbo:
             losses = self.compute_loss_split_batches_by_elbo(latent_mean, latent_logvar, vae_prev_obs, vae_next_obs,
                                                              vae_actions, vae_rewards, vae_tasks,
@@ -567,37 +749,37 @@ class VaribadVAE:
         rew_reconstruction_loss, state_reconstruction_loss, task_reconstruction_loss, kl_loss = losses
 
         # VAE loss = KL loss + reward reconstruction + state transition reconstruction
-        # take average (this is the expectation over p(M))
-        loss = (self.args.rew_loss_coeff * rew_reconstruction_loss +
-                self.args.state_loss_coeff * state_reconstruction_loss +
-                self.args.task_loss_coeff * task_reconstruction_loss +
-                self.args.kl_weight * kl_loss).mean()
+        # (the terms are already averaged over tasks in compute_loss*, i.e., the expectation over p(M), so they are scalars)
+        loss_terms = torch.stack([term if torch.is_tensor(term) else self._zero_loss for term in losses])
+        loss = torch.dot(loss_terms, self._loss_coeffs)
 
         # make sure we can compute gradients
+        # (only for the decoders that are actually trained; the others' loss terms are 0)
+        decode_reward, decode_state, decode_task = self.active_decoders()
         if not self.args.disable_kl_term:
             assert kl_loss.requires_grad
-        if self.args.decode_reward:
+        if decode_reward:
             assert rew_reconstruction_loss.requires_grad
-        if self.args.decode_state:
+        if decode_state:
             assert state_reconstruction_loss.requires_grad
-        if self.args.decode_task:
+        if decode_task:
             assert task_reconstruction_loss.requires_grad
 
         # overall loss
-        elbo_loss = loss.mean()
+        elbo_loss = loss
 
         if update:
-            self.optimiser_vae.zero_grad()
+            self.optimiser_vae.zero_grad(**self._zero_grad_kwargs)
             elbo_loss.backward()
             # clip gradients
             if self.args.encoder_max_grad_norm is not None:
                 nn.utils.clip_grad_norm_(self.encoder.parameters(), self.args.encoder_max_grad_norm)
             if self.args.decoder_max_grad_norm is not None:
-                if self.args.decode_reward:
+                if decode_reward:
                     nn.utils.clip_grad_norm_(self.reward_decoder.parameters(), self.args.decoder_max_grad_norm)
-                if self.args.decode_state:
+                if decode_state:
                     nn.utils.clip_grad_norm_(self.state_decoder.parameters(), self.args.decoder_max_grad_norm)
-                if self.args.decode_task:
+                if decode_task:
                     nn.utils.clip_grad_norm_(self.task_decoder.parameters(), self.args.decoder_max_grad_norm)
             # update
             self.optimiser_vae.step()
@@ -618,13 +800,21 @@ class VaribadVAE:
 
         if curr_iter_idx % self.args.log_interval == 0:
 
-            if self.args.decode_reward:
-                self.logger.add('vae_losses/reward_reconstr_err', rew_reconstruction_loss.mean(), curr_iter_idx)
-            if self.args.decode_state:
-                self.logger.add('vae_losses/state_reconstr_err', state_reconstruction_loss.mean(), curr_iter_idx)
-            if self.args.decode_task:
-                self.logger.add('vae_losses/task_reconstr_err', task_reconstruction_loss.mean(), curr_iter_idx)
+            # (the losses are already reduced to scalars in compute_loss*)
+            decode_reward, decode_state, decode_task = self.active_decoders()
+            to_log = []
+            if decode_reward:
+                to_log.append(('vae_losses/reward_reconstr_err', rew_reconstruction_loss))
+            if decode_state:
+                to_log.append(('vae_losses/state_reconstr_err', state_reconstruction_loss))
+            if decode_task:
+                to_log.append(('vae_losses/task_reconstr_err', task_reconstruction_loss))
 
             if not self.args.disable_kl_term:
-                self.logger.add('vae_losses/kl', kl_loss.mean(), curr_iter_idx)
-            self.logger.add('vae_losses/sum', elbo_loss, curr_iter_idx)
+                to_log.append(('vae_losses/kl', kl_loss))
+            to_log.append(('vae_losses/sum', elbo_loss))
+
+            # copy all values to the CPU at once (instead of one sync per value)
+            values = torch.stack([value.detach() for _, value in to_log]).tolist()
+            for (name, _), value in zip(to_log, values):
+                self.logger.add(name, value, curr_iter_idx)